@@ -1,5 +1,6 @@
 import { Type } from "typebox";
 import { defineTool, type AgentSession, type ToolDefinition } from "@earendil-works/pi-coding-agent";
+import { createReadStream } from "fs";
 import fs from "fs/promises";
 import path from "path";
 import type { McpServerConfig } from "@/lib/types";
@@ -38,6 +39,8 @@ import {
 
 const TELEGRAM_SEND_FILE_MAX_BYTES = 45 * 1024 * 1024;
 const IMAGE_REFERENCE_MAX_BYTES = 20 * 1024 * 1024;
+/** A multiple of 3, so every chunk encodes to base64 with no padding mid-stream. */
+const IMAGE_REFERENCE_READ_CHUNK_BYTES = 3 * 64 * 1024;
 
 interface TelegramRuntimeData {
   /** Absent when the chat runs through a bot this workspace does not own. */
@@ -83,16 +86,223 @@ function imageMimeType(filePath: string): string | null {
   return null;
 }
 
-async function fileToDataUrl(filePath: string): Promise<string> {
-  const mimeType = imageMimeType(filePath);
-  if (!mimeType) throw new Error(`Unsupported reference image type: ${filePath}`);
+const PNG_SIGNATURE = [0x89, 0x50, 0x4e, 0x47, 0x0d, 0x0a, 0x1a, 0x0a] as const;
+const JPEG_SIGNATURE = [0xff, 0xd8, 0xff] as const;
+const RIFF_SIGNATURE = [0x52, 0x49, 0x46, 0x46] as const;
+const WEBP_SIGNATURE = [0x57, 0x45, 0x42, 0x50] as const;
+const GIF87A_SIGNATURE = [0x47, 0x49, 0x46, 0x38, 0x37, 0x61] as const;
+const GIF89A_SIGNATURE = [0x47, 0x49, 0x46, 0x38, 0x39, 0x61] as const;
+
+/**
+ * Image type from the file's leading bytes.
+ *
+ * Uploads and downloads routinely carry the wrong extension (a JPEG saved as
+ * `.png`), and the data URL prefix is what the provider trusts, so the bytes
+ * win over the name whenever they are recognisable.
+ */
+function sniffImageMimeType(bytes: Uint8Array): string | null {
+  const startsWith = (signature: readonly number[], offset = 0) =>
+    bytes.length >= offset + signature.length && signature.every((value, index) => bytes[offset + index] === value);
+  if (startsWith(PNG_SIGNATURE)) return "image/png";
+  if (startsWith(JPEG_SIGNATURE)) return "image/jpeg";
+  if (startsWith(RIFF_SIGNATURE) && startsWith(WEBP_SIGNATURE, 8)) return "image/webp";
+  if (startsWith(GIF87A_SIGNATURE) || startsWith(GIF89A_SIGNATURE)) return "image/gif";
+  return null;
+}
+
+interface ReferenceImage {
+  path: string;
+  mimeType: string;
+  /** Bytes on disk when the reference was checked; the upload is held to it. */
+  size: number;
+}
+
+/** A reference image that failed while its bytes were being uploaded. */
+class ReferenceImageUploadError extends Error {
+  constructor(filePath: string, reason: unknown) {
+    const message = reason instanceof Error ? reason.message : String(reason);
+    // fs errors and size checks already name the file; do not name it twice.
+    super(`Reference image could not be uploaded: ${message.includes(filePath) ? message : `${message}: ${filePath}`}`);
+  }
+}
+
+/**
+ * Checks a reference image and reads its type without loading the whole file.
+ *
+ * A recognisable header is enough on its own, so an extensionless upload or a
+ * `.jfif` photo is accepted; the extension only decides when the bytes do not.
+ */
+async function inspectReferenceImage(filePath: string): Promise<ReferenceImage> {
   const stat = await fs.stat(filePath);
   if (!stat.isFile()) throw new Error(`Reference image is not a file: ${filePath}`);
   if (stat.size > IMAGE_REFERENCE_MAX_BYTES) {
     throw new Error(`Reference image is too large (${stat.size} bytes). Max allowed is ${IMAGE_REFERENCE_MAX_BYTES} bytes: ${filePath}`);
   }
-  const buffer = await fs.readFile(filePath);
-  return `data:${mimeType};base64,${buffer.toString("base64")}`;
+  const handle = await fs.open(filePath, "r");
+  let header: Buffer;
+  try {
+    const { buffer, bytesRead } = await handle.read(Buffer.alloc(16), 0, 16, 0);
+    header = buffer.subarray(0, bytesRead);
+  } finally {
+    await handle.close();
+  }
+  const mimeType = sniffImageMimeType(header) || imageMimeType(filePath);
+  if (!mimeType) throw new Error(`Unsupported reference image type: ${filePath}`);
+  return { path: filePath, mimeType, size: stat.size };
+}
+
+/**
+ * A file's base64 encoding, produced one bounded chunk at a time.
+ *
+ * The file must still be exactly `expectedBytes` long: reading stops as soon as
+ * it runs past that, so a file that grew since it was checked can neither
+ * overrun a promised Content-Length nor make the upload unbounded.
+ */
+async function* readFileAsBase64(filePath: string, expectedBytes: number): AsyncGenerator<Uint8Array> {
+  const changed = () => new Error(`File changed after it was checked (expected ${expectedBytes} bytes): ${filePath}`);
+  let bytesRead = 0;
+  let carry: Buffer = Buffer.alloc(0);
+  for await (const chunk of createReadStream(filePath, { highWaterMark: IMAGE_REFERENCE_READ_CHUNK_BYTES })) {
+    bytesRead += (chunk as Buffer).length;
+    if (bytesRead > expectedBytes) throw changed();
+    // Reads are not guaranteed to land on the chunk size; hold back the bytes
+    // that would break 3-byte alignment until the next read. They are copied
+    // so the carry does not pin the whole previous chunk.
+    const bytes = carry.length > 0 ? Buffer.concat([carry, chunk as Buffer]) : chunk as Buffer;
+    const aligned = bytes.length - (bytes.length % 3);
+    carry = Buffer.from(bytes.subarray(aligned));
+    if (aligned > 0) yield Buffer.from(bytes.subarray(0, aligned).toString("base64"), "latin1");
+  }
+  if (bytesRead !== expectedBytes) throw changed();
+  if (carry.length > 0) yield Buffer.from(carry.toString("base64"), "latin1");
+}
+
+/**
+ * The image request body with reference images streamed in as data URLs.
+ *
+ * References are most of the payload. Building it with JSON.stringify held each
+ * one as bytes, base64, data URL, JSON text and UTF-8 body all at once; here the
+ * envelope is serialised without them and each file is read and encoded in
+ * small chunks as the upload reaches it. The files go out exactly as they sit
+ * on disk: no decode, no re-encode.
+ *
+ * The exact length is known up front from the checked file sizes, so the body
+ * is sent with a Content-Length rather than chunked, which some proxies and
+ * OpenAI-compatible gateways refuse.
+ */
+function streamImageRequestBody(
+  body: Record<string, unknown>,
+  references: ReferenceImage[]
+): { stream: ReadableStream<Uint8Array>; length: number } {
+  const head = Buffer.from(`${JSON.stringify(body).slice(0, -1)},"input_references":[`);
+  const urlOpenings = references.map((reference, index) =>
+    Buffer.from(`${index > 0 ? "," : ""}{"type":"image_url","image_url":{"url":"data:${reference.mimeType};base64,`)
+  );
+  const urlClose = Buffer.from('"}}');
+  const tail = Buffer.from("]}");
+  const length = references.reduce(
+    (total, reference, index) => total + urlOpenings[index].length + 4 * Math.ceil(reference.size / 3) + urlClose.length,
+    head.length + tail.length
+  );
+
+  async function* parts(): AsyncGenerator<Uint8Array> {
+    yield head;
+    for (let index = 0; index < references.length; index += 1) {
+      const reference = references[index];
+      yield urlOpenings[index];
+      try {
+        // Held to the checked size, so the promised Content-Length stays true.
+        yield* readFileAsBase64(reference.path, reference.size);
+      } catch (error) {
+        throw new ReferenceImageUploadError(reference.path, error);
+      }
+      yield urlClose;
+    }
+    yield tail;
+  }
+
+  const iterator = parts();
+  const stream = new ReadableStream<Uint8Array>({
+    async pull(controller) {
+      const { value, done } = await iterator.next();
+      if (done) controller.close();
+      else controller.enqueue(value);
+    },
+    async cancel() {
+      await iterator.return(undefined);
+    },
+  });
+  return { stream, length };
+}
+
+/**
+ * Sends one fetch to the image endpoint with a failure that says what broke.
+ *
+ * fetch reports network and body-stream failures as a bare "fetch failed" and
+ * hides the reason in `cause`; surface the reference that broke the upload, or
+ * at least the endpoint and the underlying reason.
+ */
+async function fetchImageEndpoint(url: string, init: RequestInit & { duplex?: "half" }): Promise<Response> {
+  try {
+    return await fetch(url, init);
+  } catch (error) {
+    const cause = error && typeof error === "object" ? (error as { cause?: unknown }).cause : undefined;
+    if (cause instanceof ReferenceImageUploadError) throw cause;
+    const causeRecord = cause && typeof cause === "object" ? cause as { message?: unknown; code?: unknown } : {};
+    const detail = [causeRecord.message, causeRecord.code, error instanceof Error ? error.message : String(error)]
+      .find((value): value is string => typeof value === "string" && value.trim().length > 0);
+    throw new Error(`Image request to ${url} failed: ${detail || "unknown network error"}`);
+  }
+}
+
+/**
+ * POSTs an image request, streaming reference images when there are any.
+ *
+ * A streamed body cannot be replayed, so fetch refuses every redirect for it
+ * where a plain JSON body would have been followed. A 307/308 to the same host
+ * (http to https included) keeps the method and body, so it is followed once by
+ * hand with a fresh stream that re-reads the files. Anything else is reported
+ * with its target so the base URL can be corrected in Settings.
+ */
+async function postImageRequest(
+  endpoint: string,
+  headers: Record<string, string>,
+  body: Record<string, unknown>,
+  references: ReferenceImage[]
+): Promise<Response> {
+  if (references.length === 0) {
+    return fetchImageEndpoint(endpoint, { method: "POST", headers, body: JSON.stringify(body) });
+  }
+
+  let url = endpoint;
+  for (let attempt = 0; ; attempt += 1) {
+    const upload = streamImageRequestBody(body, references);
+    // Node's fetch needs duplex: "half" for a streamed body; the DOM typings
+    // do not know the field yet.
+    const response = await fetchImageEndpoint(url, {
+      method: "POST",
+      headers: { ...headers, "Content-Length": String(upload.length) },
+      body: upload.stream,
+      duplex: "half",
+      redirect: "manual",
+    });
+    if (response.status < 300 || response.status >= 400) return response;
+
+    await response.body?.cancel().catch(() => undefined);
+    const location = response.headers.get("location");
+    const target = location ? new URL(location, url) : null;
+    const source = new URL(url);
+    const sameHost = target !== null
+      && target.hostname === source.hostname
+      && (target.protocol === source.protocol || target.protocol === "https:");
+    if (attempt === 0 && sameHost && (response.status === 307 || response.status === 308)) {
+      url = target.toString();
+      continue;
+    }
+    throw new Error(
+      `Image endpoint ${url} redirected (HTTP ${response.status}) to ${target?.toString() || "an unspecified location"}; update the image provider base URL in Settings.`
+    );
+  }
 }
 
 async function readJsonFile(filePath: string): Promise<Record<string, unknown>> {
@@ -164,10 +374,25 @@ function imageExtension(mediaType?: string): string {
   return "png";
 }
 
+/**
+ * Decodes a bare base64 image or a base64 data URL.
+ *
+ * Only the short prefix is inspected; the payload itself goes straight to
+ * Node's lenient decoder, which skips embedded whitespace, instead of through a
+ * regex over several megabytes.
+ */
 function decodeBase64Image(raw: string): { buffer: Buffer; mediaType?: string } {
-  const dataUrl = /^data:([^;,]+);base64,(.+)$/s.exec(raw);
-  if (dataUrl) return { mediaType: dataUrl[1], buffer: Buffer.from(dataUrl[2], "base64") };
-  return { buffer: Buffer.from(raw, "base64") };
+  const value = raw.trim();
+  if (value.startsWith("data:")) {
+    const comma = value.indexOf(",");
+    const header = comma >= 0 ? value.slice(5, comma) : "";
+    // RFC 2397 media type parameters, the base64 marker included, are case-insensitive.
+    if (header.toLowerCase().endsWith(";base64")) {
+      const mediaType = header.split(";")[0].trim();
+      return { mediaType: mediaType || undefined, buffer: Buffer.from(value.slice(comma + 1), "base64") };
+    }
+  }
+  return { buffer: Buffer.from(value, "base64") };
 }
 
 async function writeGeneratedImages(options: { cwd?: string }, payload: unknown): Promise<Array<{ path: string; mediaType?: string; source: string }>> {
@@ -190,7 +415,10 @@ async function writeGeneratedImages(options: { cwd?: string }, payload: unknown)
           : "";
     if (!b64) continue;
     const decoded = decodeBase64Image(b64);
-    const mediaType = typeof image.media_type === "string" ? image.media_type : decoded.mediaType;
+    // Bytes are written as received, never re-encoded, so the extension has to
+    // follow what they actually are rather than what the provider declared.
+    const mediaType = sniffImageMimeType(decoded.buffer)
+      || (typeof image.media_type === "string" ? image.media_type : decoded.mediaType);
     const ext = imageExtension(mediaType);
     const filePath = path.join(outputDir, `eggent-image-${new Date().toISOString().replace(/[:.]/g, "-")}-${index + 1}.${ext}`);
     await fs.writeFile(filePath, decoded.buffer);
@@ -761,13 +989,9 @@ export async function createEggentPiTools(options: {
         }
 
         const referencePaths = (params.reference_image_paths || []).map((item) => resolveLocalFilePath(options, item));
-        const inputReferences: Array<{ type: "image_url"; image_url: { url: string } }> = [];
-        for (const referencePath of referencePaths) {
-          inputReferences.push({
-            type: "image_url",
-            image_url: { url: await fileToDataUrl(referencePath) },
-          });
-        }
+        // References are independent reads; check them together and keep the
+        // order the caller gave, since prompts refer to "the first image".
+        const inputReferences = await Promise.all(referencePaths.map(inspectReferenceImage));
 
         const body: Record<string, unknown> = {
           model: backend.model,
@@ -783,21 +1007,17 @@ export async function createEggentPiTools(options: {
         body.quality = params.quality || "medium";
         if (params.output_format) body.output_format = params.output_format;
         if (params.background) body.background = params.background;
-        if (inputReferences.length > 0) body.input_references = inputReferences;
 
         // The managed gateway exposes /images and routes by header; a provider
         // the user brought is plain OpenAI-compatible, so it gets the standard
         // /images/generations path and none of our routing headers.
         const endpoint = backend.managed ? `${backend.baseUrl}/images` : `${backend.baseUrl}/images/generations`;
-        const response = await fetch(endpoint, {
-          method: "POST",
-          headers: {
-            Authorization: `Bearer ${backend.token}`,
-            "Content-Type": "application/json",
-            ...(backend.managed ? { "X-Eggent-AI-Request-Type": "image" } : {}),
-          },
-          body: JSON.stringify(body),
-        });
+        const headers: Record<string, string> = {
+          Authorization: `Bearer ${backend.token}`,
+          "Content-Type": "application/json",
+          ...(backend.managed ? { "X-Eggent-AI-Request-Type": "image" } : {}),
+        };
+        const response = await postImageRequest(endpoint, headers, body, inputReferences);
         const responseText = await response.text();
         let payload: unknown = null;
         try {